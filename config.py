@@ -11,6 +11,11 @@ CONFIG = {
     'retry_start_hour': 13,  # EET hour to start retries
     'retry_end_hour': 18,  # Stop retries after
     'retry_minutes': 30,  # Attempt at :30 past hour
+    'fetch_attempts': 3,  # HTTP attempts per fetch on 5xx/timeout
+    'poll_backoff_min': 1.0,  # Seconds before first retry (also jitter scale)
+    'poll_backoff_max': 30,  # Cap on backoff seconds
+    'poll_backoff_base': 1.3,  # Growth factor per attempt
+    'price_cache_ttl_hours': 12,  # In-process reuse of fetched prices (published prices don't change)
     
     # Discharge settings
     'min_price_threshold': 20,  # €/MWh to trigger discharge
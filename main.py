@@ -1,89 +1,173 @@
 #!/usr/bin/env python3
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
 import os
-import glob
 import time
+import asyncio
+import signal
+import random
+import functools
 from datetime import datetime, timedelta
-import pytz
+from zoneinfo import ZoneInfo
 import argparse
+try:
+    import orjson as json_lib  # Optional, faster decode of the price payload
+except ImportError:
+    import json as json_lib
 from config import CONFIG
 
 # Set EET timezone
-EET = pytz.timezone('Europe/Riga')
+EET = ZoneInfo('Europe/Riga')
 
-def get_daily_log_file(prefix):
-    date_str = datetime.now(EET).strftime('%Y-%m-%d')
+_LOG_FDS = {}  # prefix -> (dated log path, O_APPEND fd), reopened when the date rolls over
+
+def get_daily_log_file(prefix, now=None):
+    date_str = (now or datetime.now(EET)).strftime('%Y-%m-%d')
     return os.path.join(CONFIG['saves_folder'], f"{prefix}_{date_str}.txt")
 
-def log_message(msg, prefix):
-    log_file = get_daily_log_file(prefix)
-    timestamp = datetime.now(EET).strftime('%Y-%m-%d %H:%M:%S EET')
+def log_message(msg, prefix, now=None):
+    now = now or datetime.now(EET)
+    log_file = get_daily_log_file(prefix, now)
+    timestamp = now.strftime('%Y-%m-%d %H:%M:%S EET')
     full_msg = f"[{timestamp}] {msg}"
     print(full_msg)
-    os.makedirs(CONFIG['saves_folder'], exist_ok=True)
-    with open(log_file, 'a') as f:
-        f.write(full_msg + '\n')
+    cached = _LOG_FDS.get(prefix)
+    if cached is None or cached[0] != log_file:
+        if cached is not None:
+            os.close(cached[1])
+        os.makedirs(CONFIG['saves_folder'], exist_ok=True)
+        fd = os.open(log_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        cached = _LOG_FDS[prefix] = (log_file, fd)
+    # O_APPEND makes each single write atomic at end-of-file, no seek or lock needed
+    os.write(cached[1], (full_msg + '\n').encode('utf-8'))
+
+def prune_saves(prefix, ext):
+    # Keep the newest max_files "<prefix>_YYYY-MM-DD<ext>" files, return deleted names
+    with os.scandir(CONFIG['saves_folder']) as it:
+        names = [e.name for e in it if e.name.startswith(prefix + '_') and e.name.endswith(ext)]
+    if len(names) <= CONFIG['max_files']:
+        return []
+    # ISO dates in the filename sort lexically, newest first
+    names.sort(reverse=True)
+    old_names = names[CONFIG['max_files']:]
+    for name in old_names:
+        os.remove(os.path.join(CONFIG['saves_folder'], name))
+    return old_names
 
 def cleanup_old_logs(prefix):
-    pattern = os.path.join(CONFIG['saves_folder'], f"{prefix}_*.txt")
-    files = glob.glob(pattern)
-    if len(files) <= CONFIG['max_files']:
-        return
-    files.sort(key=lambda f: os.path.basename(f).split('_')[-1].replace('.txt', ''), reverse=True)
-    for old_file in files[CONFIG['max_files']:]:
-        os.remove(old_file)
-        log_message(f"Deleted old log: {old_file}", prefix)
+    deleted = prune_saves(prefix, '.txt')
+    if deleted:
+        log_message("Deleted old logs: " + ", ".join(deleted), prefix)
 
 def create_saves_folder():
     os.makedirs(CONFIG['saves_folder'], exist_ok=True)
 
-def fetch_prices(target_date):
+def backoff_delay(attempt):
+    base = CONFIG['poll_backoff_min']
+    delay = min(CONFIG['poll_backoff_max'], base * (CONFIG['poll_backoff_base'] ** attempt))
+    return delay + random.uniform(0, 0.5 * base)
+
+class JitteredRetry(Retry):
+    # urllib3 Retry that sleeps on our backoff_delay() curve between attempts
+    def get_backoff_time(self):
+        if not self.history:
+            return 0
+        return backoff_delay(len(self.history) - 1)
+
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=2, max_retries=JitteredRetry(
+    total=CONFIG['fetch_attempts'] - 1,
+    status_forcelist=[500, 502, 503, 504],
+    raise_on_status=False,
+)))
+
+def parse_prices(response, target_date):
+    if response.status_code == 200:
+        data = json_lib.loads(response.content)
+        entries = data.get('multiAreaEntries')
+        if entries:
+            area = CONFIG['delivery_area']
+            starts = pd.to_datetime([e['deliveryStart'] for e in entries], utc=True).tz_convert(EET)
+            ends = pd.to_datetime([e['deliveryEnd'] for e in entries], utc=True).tz_convert(EET)
+            df = pd.DataFrame({
+                'StartTime': starts.strftime('%H:%M'),
+                'EndTime': ends.strftime('%H:%M'),
+                'Price': [e['entryPerArea'].get(area, 0) for e in entries],
+            })
+            df['Price'] = df['Price'].round(2)
+            log_message(f"Success: Fetched {len(df)} 15-min slots for {target_date} (EET times)", CONFIG['fetch_log_prefix'])
+            return df
+        else:
+            log_message(f"No multiAreaEntries for {target_date}", CONFIG['fetch_log_prefix'])
+            return None
+    elif response.status_code == 204:
+        log_message(f"204 No Content for {target_date} (pre-auction)", CONFIG['fetch_log_prefix'])
+        return None
+    else:
+        log_message(f"API error: {response.text[:200]}", CONFIG['fetch_log_prefix'])
+        return None
+
+def ttl_cache(ttl_sec, maxsize=8):
+    # Memoise non-None results per key for ttl_sec; None (204/errors) always re-runs
+    def decorator(func):
+        cache = {}
+        @functools.wraps(func)
+        def wrapper(key):
+            hit = cache.get(key)
+            if hit is not None and time.monotonic() - hit[0] < ttl_sec:
+                return hit[1]
+            result = func(key)
+            if result is not None:
+                cache.pop(key, None)
+                cache[key] = (time.monotonic(), result)
+                while len(cache) > maxsize:
+                    cache.pop(next(iter(cache)))
+            return result
+        return wrapper
+    return decorator
+
+@ttl_cache(CONFIG['price_cache_ttl_hours'] * 3600)
+def fetch_from_api(target_date):
+    # Only API results are memoised; the saved-CSV fallback in fetch_prices is not
     url = f"https://dataportal-api.nordpoolgroup.com/api/DayAheadPrices?date={target_date}&market=DayAhead&deliveryArea={CONFIG['delivery_area']}&currency=EUR"
     try:
-        response = requests.get(url, timeout=10)
+        response = SESSION.get(url, timeout=(3.05, 10))
         log_message(f"Fetch for {target_date}: status {response.status_code}", CONFIG['fetch_log_prefix'])
-        if response.status_code == 200:
-            data = response.json()
-            if 'multiAreaEntries' in data and data['multiAreaEntries']:
-                df = pd.DataFrame(data['multiAreaEntries'])
-                df['deliveryStart'] = pd.to_datetime(df['deliveryStart'])
-                df['deliveryEnd'] = pd.to_datetime(df['deliveryEnd'])
-                df['local_start'] = df['deliveryStart'].dt.tz_convert(EET)
-                df['local_end'] = df['deliveryEnd'].dt.tz_convert(EET)
-                df['StartTime'] = df['local_start'].dt.strftime('%H:%M')
-                df['EndTime'] = df['local_end'].dt.strftime('%H:%M')
-                df['Price'] = df['entryPerArea'].apply(lambda x: x.get('LV', 0))
-                df['Price'] = df['Price'].round(2)
-                log_message(f"Success: Fetched {len(df)} 15-min slots for {target_date} (EET times)", CONFIG['fetch_log_prefix'])
-                return df[['StartTime', 'EndTime', 'Price']]
-            else:
-                log_message(f"No multiAreaEntries for {target_date}", CONFIG['fetch_log_prefix'])
-                return None
-        elif response.status_code == 204:
-            log_message(f"204 No Content for {target_date} (pre-auction)", CONFIG['fetch_log_prefix'])
-            return None
-        else:
-            log_message(f"API error: {response.text[:200]}", CONFIG['fetch_log_prefix'])
-            return None
+        return parse_prices(response, target_date)
     except Exception as e:
         log_message(f"Exception fetching {target_date}: {e}", CONFIG['fetch_log_prefix'])
         return None
 
+def fetch_prices(target_date):
+    df = fetch_from_api(target_date)
+    if df is not None:
+        return df
+    return load_from_cache(target_date)
+
+def load_from_cache(target_date):
+    # Day-ahead prices never change once published, so a saved CSV for the date stays valid
+    filepath = os.path.join(CONFIG['saves_folder'], f"lv_prices_{target_date}.csv")
+    if not os.path.exists(filepath):
+        return None
+    try:
+        df = pd.read_csv(filepath, dtype={'StartTime': str, 'EndTime': str, 'Price': float})
+    except Exception as e:
+        log_message(f"Failed to read saved prices for {target_date}: {e}", CONFIG['fetch_log_prefix'])
+        return None
+    log_message(f"Serving saved prices for {target_date} from {filepath}", CONFIG['fetch_log_prefix'])
+    return df
+
 def save_to_csv(df, filename):
     filepath = os.path.join(CONFIG['saves_folder'], filename)
-    df.to_csv(filepath, index=False)
+    df.to_csv(filepath, index=False, float_format='%.2f', lineterminator='\n')
     log_message(f"Saved: {filepath}", CONFIG['fetch_log_prefix'])
 
 def cleanup_old_files():
-    pattern = os.path.join(CONFIG['saves_folder'], 'lv_prices_*.csv')
-    files = glob.glob(pattern)
-    if len(files) <= CONFIG['max_files']:
-        return
-    files.sort(key=lambda f: os.path.basename(f).split('_')[-1].replace('.csv', ''), reverse=True)
-    for old_file in files[CONFIG['max_files']:]:
-        os.remove(old_file)
-        log_message(f"Deleted old CSV: {old_file}", CONFIG['fetch_log_prefix'])
+    deleted = prune_saves('lv_prices', '.csv')
+    if deleted:
+        log_message("Deleted old files: " + ", ".join(deleted), CONFIG['fetch_log_prefix'])
 
 def run_today_discharge():
     today = datetime.now(EET).strftime('%Y-%m-%d')
@@ -93,32 +177,72 @@ def run_today_discharge():
         filename = f"lv_prices_{today}.csv"
         save_to_csv(df, filename)
         cleanup_old_files()
-        log_message("Today's data ready → launching solar_discharge.py", CONFIG['fetch_log_prefix'])
-        os.system("python3 solar_discharge.py")
+        log_message("Today's data ready → running solar_discharge", CONFIG['fetch_log_prefix'])
+        # Imported here so pymodbus problems can't stop the fetcher from starting;
+        # failures are logged and monitor_tomorrow still runs
+        try:
+            import solar_discharge
+            solar_discharge.main(test_mode=False)
+        except Exception as e:
+            log_message(f"solar_discharge failed: {e}", CONFIG['fetch_log_prefix'])
     else:
         log_message("Failed to fetch today's data", CONFIG['fetch_log_prefix'])
 
-def monitor_tomorrow():
+def next_retry_instant(now_eet):
+    # Next :30 slot inside the retry window, or None once the window has passed
+    retry_at = now_eet.replace(minute=CONFIG['retry_minutes'], second=0, microsecond=0)
+    if retry_at <= now_eet:
+        retry_at += timedelta(hours=1)
+    window_start = now_eet.replace(hour=CONFIG['retry_start_hour'], minute=CONFIG['retry_minutes'], second=0, microsecond=0)
+    window_end = now_eet.replace(hour=CONFIG['retry_end_hour'], minute=CONFIG['retry_minutes'], second=0, microsecond=0)
+    if retry_at > window_end:
+        return None
+    return max(retry_at, window_start)
+
+async def wait_for_stop(stop_event, timeout):
+    # Sleep up to timeout; True if stop_event fired first
+    try:
+        await asyncio.wait_for(stop_event.wait(), timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+async def monitor_tomorrow():
     tomorrow = (datetime.now(EET) + timedelta(days=1)).strftime('%Y-%m-%d')
     log_message(f"Starting monitoring for tomorrow's data ({tomorrow})", CONFIG['fetch_log_prefix'])
     
+    # SIGTERM/SIGINT only wake the retry sleep; an in-flight fetch is left to finish
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_event.set)
+    
+    stop_at = datetime.now(EET).replace(hour=CONFIG['retry_end_hour'], minute=CONFIG['retry_minutes'], second=0, microsecond=0)
+    if datetime.now(EET) > stop_at:
+        log_message(f"Past {stop_at.strftime('%H:%M')} EET — skipping tomorrow fetch attempts", CONFIG['fetch_log_prefix'])
+        return
+    # The stop_at slot itself is attempted; next_retry_instant returns None after it
     while True:
-        now_eet = datetime.now(EET)
-        if now_eet.hour >= CONFIG['retry_end_hour'] and now_eet.minute >= 30:
-            log_message("Reached 18:30 EET — stopping tomorrow fetch attempts", CONFIG['fetch_log_prefix'])
-            break
-        
-        df = fetch_prices(tomorrow)
+        # Blocking HTTP (Session + retry adapter) runs off the event loop
+        df = await asyncio.to_thread(fetch_prices, tomorrow)
         if df is not None:
             filename = f"lv_prices_{tomorrow}.csv"
             save_to_csv(df, filename)
             cleanup_old_files()
             log_message(f"Tomorrow's data ({tomorrow}) fetched and saved!", CONFIG['fetch_log_prefix'])
-            break
+            return
         else:
-            wait_min = 30 - now_eet.minute if now_eet.minute < 30 else 60 - now_eet.minute
-            log_message(f"Tomorrow's data not ready → retry in {wait_min} min", CONFIG['fetch_log_prefix'])
-            time.sleep(wait_min * 60)
+            now_eet = datetime.now(EET)
+            retry_at = next_retry_instant(now_eet)
+            if retry_at is None:
+                break
+            # Same-tzinfo subtraction is wall-clock; timestamps give the real gap across DST
+            sleep_sec = max(1, retry_at.timestamp() - now_eet.timestamp())
+            log_message(f"Tomorrow's data not ready → retry at {retry_at.strftime('%H:%M')} EET", CONFIG['fetch_log_prefix'], now_eet)
+            if await wait_for_stop(stop_event, sleep_sec):
+                log_message("Shutdown signal received — stopping tomorrow fetch attempts", CONFIG['fetch_log_prefix'])
+                return
+    log_message(f"Reached {stop_at.strftime('%H:%M')} EET — stopping tomorrow fetch attempts", CONFIG['fetch_log_prefix'])
 
 def main():
     parser = argparse.ArgumentParser()
@@ -137,7 +261,7 @@ def main():
     run_today_discharge()
     
     # 2. Then start monitoring for tomorrow
-    monitor_tomorrow()
+    asyncio.run(monitor_tomorrow())
     
     log_message("All tasks completed — exiting. Restart daily.", CONFIG['fetch_log_prefix'])
 
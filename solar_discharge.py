@@ -1,44 +1,55 @@
 #!/usr/bin/env python3
-import pandas as pd
+import csv
 import sys
 import os
-import glob
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-import pytz  # For EET
-from pymodbus.exceptions import ModbusException
-from pymodbus.client import ModbusTcpClient  # Or ModbusSerialClient for RS485
+from zoneinfo import ZoneInfo  # For EET
 from config import CONFIG  # Import unified config
 
 # Set EET timezone
-EET = pytz.timezone('Europe/Riga')
+EET = ZoneInfo('Europe/Riga')
 
-def get_daily_log_file(prefix):
+_LOG_FDS = {}  # prefix -> (dated log path, O_APPEND fd), reopened when the date rolls over
+
+def get_daily_log_file(prefix, now=None):
     """Get dated log file in saves/ (e.g., saves/discharge_log_2025-12-01.txt)."""
-    date_str = datetime.now(EET).strftime('%Y-%m-%d')
+    date_str = (now or datetime.now(EET)).strftime('%Y-%m-%d')
     return os.path.join(CONFIG['saves_folder'], f"{prefix}_{date_str}.txt")
 
-def log_message(msg, prefix):
-    """Append to dated log in saves/."""
-    log_file = get_daily_log_file(prefix)
-    timestamp = datetime.now(EET).strftime('%Y-%m-%d %H:%M:%S EET')
+def log_message(msg, prefix, now=None):
+    """Append to dated log in saves/, keeping the file open between calls.
+
+    Pass now to reuse a timestamp the caller already has.
+    """
+    now = now or datetime.now(EET)
+    log_file = get_daily_log_file(prefix, now)
+    timestamp = now.strftime('%Y-%m-%d %H:%M:%S EET')
     full_msg = f"[{timestamp}] {msg}"
     print(full_msg)
-    os.makedirs(CONFIG['saves_folder'], exist_ok=True)
-    with open(log_file, 'a') as f:
-        f.write(full_msg + '\n')
+    cached = _LOG_FDS.get(prefix)
+    if cached is None or cached[0] != log_file:
+        if cached is not None:
+            os.close(cached[1])
+        os.makedirs(CONFIG['saves_folder'], exist_ok=True)
+        fd = os.open(log_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        cached = _LOG_FDS[prefix] = (log_file, fd)
+    # O_APPEND makes each single write atomic at end-of-file, no seek or lock needed
+    os.write(cached[1], (full_msg + '\n').encode('utf-8'))
 
 def cleanup_old_logs(prefix):
     """Keep only the latest 10 log files for this prefix."""
-    pattern = os.path.join(CONFIG['saves_folder'], f"{prefix}_*.txt")
-    files = glob.glob(pattern)
-    if len(files) <= CONFIG['max_files']:
+    with os.scandir(CONFIG['saves_folder']) as it:
+        names = [e.name for e in it if e.name.startswith(prefix + '_') and e.name.endswith('.txt')]
+    if len(names) <= CONFIG['max_files']:
         return
-    # Sort by filename date (desc: newest first)
-    files.sort(key=lambda f: os.path.basename(f).split('_')[-1].replace('.txt', ''), reverse=True)
-    # Delete oldest (beyond 10)
-    for old_file in files[CONFIG['max_files']:]:
-        os.remove(old_file)
-        log_message(f"Deleted old log: {old_file}", prefix)
+    # Sort by filename date (desc: newest first); ISO dates sort lexically
+    names.sort(reverse=True)
+    # Delete oldest (beyond 10), logging them in one line
+    old_names = names[CONFIG['max_files']:]
+    for name in old_names:
+        os.remove(os.path.join(CONFIG['saves_folder'], name))
+    log_message("Deleted old logs: " + ", ".join(old_names), prefix)
 
 def find_peak_slot():
     """Read latest CSV from saves/, find max Price 15-min slot above threshold."""
@@ -61,42 +72,51 @@ def find_peak_slot():
             log_message("No today's data either—run fetcher with --test-today first", CONFIG['discharge_log_prefix'])
             return None
     
-    df = pd.read_csv(filepath)
-    df['Price'] = df['Price'].astype(float)
-    df_filtered = df[df['Price'] >= CONFIG['min_price_threshold']]
-    if df_filtered.empty:
+    with open(filepath, newline='') as f:
+        # Blank Price cells (NaN in the fetcher) are skipped, as pd.read_csv + filter did
+        rows = [(r['StartTime'], r['EndTime'], float(r['Price'])) for r in csv.DictReader(f) if r['Price']]
+    rows = [r for r in rows if r[2] >= CONFIG['min_price_threshold']]
+    if not rows:
         log_message(f"No slots above €{CONFIG['min_price_threshold']} threshold", CONFIG['discharge_log_prefix'])
         return None
     
-    peak_idx = df_filtered['Price'].idxmax()
-    peak_row = df_filtered.loc[peak_idx]
-    log_message(f"Peak slot: {peak_row['StartTime']}–{peak_row['EndTime']} at €{peak_row['Price']:.2f}/MWh", CONFIG['discharge_log_prefix'])
+    start_time, end_time, price = max(rows, key=lambda r: r[2])
+    log_message(f"Peak slot: {start_time}–{end_time} at €{price:.2f}/MWh", CONFIG['discharge_log_prefix'])
     return {
-        'start_time': peak_row['StartTime'],
-        'end_time': peak_row['EndTime'],
-        'price': peak_row['Price']
+        'start_time': start_time,
+        'end_time': end_time,
+        'price': price
     }
 
-def discharge_command(start_time, duration_min):
-    """Real Modbus write for 15-min discharge at start_time."""
+@contextmanager
+def modbus_client():
+    """Yield a connected Modbus client (TCP or RS485 per CONFIG), closing it afterwards.
+
+    pymodbus is imported here so --test and no-peak runs never load it.
+    """
+    from pymodbus.client import ModbusTcpClient, ModbusSerialClient
+    from pymodbus.exceptions import ModbusException
+    if CONFIG['use_tcp']:
+        client = ModbusTcpClient(CONFIG['modbus_host'], port=CONFIG['modbus_port'])
+    else:
+        client = ModbusSerialClient(method='rtu', port=CONFIG['modbus_host'], baudrate=CONFIG['modbus_port'], bytesize=8, parity='N', stopbits=1)
+    client.connect()
     try:
-        if CONFIG['use_tcp']:
-            client = ModbusTcpClient(CONFIG['modbus_host'], port=CONFIG['modbus_port'])
-        else:
-            from pymodbus.client import ModbusSerialClient
-            client = ModbusSerialClient(method='rtu', port=CONFIG['modbus_host'], baudrate=CONFIG['modbus_port'], bytesize=8, parity='N', stopbits=1)
-        
-        client.connect()
         if not client.connected:
             raise ModbusException("Connection failed")
-        
-        # Parse start_time to hour/min for SolaX registers (adapt per manual, e.g., 0x011A hour, 0x011B min)
-        h, m = map(int, start_time.split(':'))
-        client.write_register(0x011A, h, unit=CONFIG['modbus_unit'])  # Start hour
-        client.write_register(0x011B, m, unit=CONFIG['modbus_unit'])  # Start min
-        client.write_register(0x011C, duration_min, unit=CONFIG['modbus_unit'])  # Duration min
-        client.write_register(0x0100, 35, unit=CONFIG['modbus_unit'])  # Timed discharge mode
+        yield client
+    finally:
         client.close()
+
+def discharge_command(start_time, duration_min):
+    """Real Modbus write for 15-min discharge at start_time."""
+    try:
+        with modbus_client() as client:
+            # Parse start_time to hour/min for SolaX registers (adapt per manual, e.g., 0x011A hour, 0x011B min)
+            h, m = map(int, start_time.split(':'))
+            # Start hour, start min, duration min are contiguous: one write_registers PDU
+            client.write_registers(0x011A, [h, m, duration_min], unit=CONFIG['modbus_unit'])
+            client.write_register(0x0100, 35, unit=CONFIG['modbus_unit'])  # Timed discharge mode
         log_message(f"Discharge scheduled: {start_time} for {duration_min} min via Modbus", CONFIG['discharge_log_prefix'])
         return True
     except Exception as e:
@@ -105,21 +125,13 @@ def discharge_command(start_time, duration_min):
 
 def test_connection():
     try:
-        if CONFIG['use_tcp']:
-            client = ModbusTcpClient(CONFIG['modbus_host'], port=CONFIG['modbus_port'])
-        else:
-            from pymodbus.client import ModbusSerialClient
-            client = ModbusSerialClient(method='rtu', port=CONFIG['modbus_host'], baudrate=CONFIG['modbus_port'], bytesize=8, parity='N', stopbits=1)
-        client.connect()
-        if client.connected:
+        with modbus_client() as client:
             result = client.read_holding_registers(0, 1, unit=CONFIG['modbus_unit'])
-            log_message(f"Connection SUCCESS: Register 0 = {result.registers}", CONFIG['discharge_log_prefix'])
-            client.close()
-            return True
-        else:
-            raise ModbusException("Not connected")
+        log_message(f"Connection SUCCESS: Register 0 = {result.registers}", CONFIG['discharge_log_prefix'])
+        return True
     except Exception as e:
-        log_message(f"Connection test FAILED:")
+        log_message(f"Connection test FAILED: {e}", CONFIG['discharge_log_prefix'])
+        return False
 
 def main(test_mode=False):
     log_message("Solar discharge optimizer started", CONFIG['discharge_log_prefix'])